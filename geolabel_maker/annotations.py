@@ -1,7 +1,10 @@
 """Create COCO annotations"""
 
 # Import
-from pathlib import Path
+from concurrent.futures import ProcessPoolExecutor
+from contextlib import ExitStack
+from itertools import repeat
+import os
 import json
 from datetime import datetime
 from PIL import Image
@@ -9,6 +12,8 @@ import numpy as np
 from skimage import measure
 from shapely.geometry import Polygon
 
+from geolabel_maker import utils
+
 
 def _create_sub_masks(mask_image, colors):
     """
@@ -21,30 +26,32 @@ def _create_sub_masks(mask_image, colors):
         -------
         a dictionary of sub-masks indexed by RGB colors
     """
+    if not colors:
+        return {}
+
     width, height = mask_image.size
 
+    # pack the RGB values of each pixel in a single integer
+    packed = utils.pack_rgb(mask_image)
+    keys = utils.pack_rgb(np.array(colors, dtype=np.uint8)).tolist()
+
+    # find the colors present in the image, most tiles
+    # only contain a few of the categories
+    present = set(np.unique(packed).tolist())
+
     # initialize a dictionary of sub-masks indexed by RGB colors
     sub_masks = {}
-    for x in range(width):
-        for y in range(height):
-            # get the RGB values of the pixel
-            pixel = mask_image.getpixel((x, y))
-
-            # if the pixel has a color used in a category
-            if pixel in colors:
-                # check to see if we've created a sub-mask...
-                sub_mask = sub_masks.get(pixel)
-                if sub_mask is None:
-                    # create a sub-mask (one bit per pixel)
-                    # and add to the dictionary
-                    # Note: we add 1 pixel of padding in each direction
-                    # because the contours module doesn't handle cases
-                    # where pixels bleed to the edge of the image
-                    sub_masks[pixel] = Image.new("1", (width + 2, height + 2))
-
-                # set the pixel value to 1 (default is 0),
-                # accounting for padding
-                sub_masks[pixel].putpixel((x + 1, y + 1), 1)
+    for color, key in zip(colors, keys):
+        if key not in present:
+            continue
+
+        # create a sub-mask (one byte per pixel)
+        # Note: we add 1 pixel of padding in each direction
+        # because the contours module doesn't handle cases
+        # where pixels bleed to the edge of the image
+        sub_mask = np.zeros((height + 2, width + 2), dtype=np.uint8)
+        sub_mask[1:-1, 1:-1] = packed == key
+        sub_masks[color] = sub_mask
 
     return sub_masks
 
@@ -55,7 +62,7 @@ def _create_sub_mask_annotation(
     """
             Parameters
             ----------
-            sub_mask : PIL Image
+            sub_mask : numpy 2D-array
 
             image_id : int
 
@@ -113,7 +120,53 @@ def _create_sub_mask_annotation(
     return last_annotation_id, annotations
 
 
-def _write_annotations(dir_label, images_ids, categories, is_crowd):
+def _annotate_label(file, image_id, categories, is_crowd, annotation_id=1):
+    """
+        Parameters
+        ----------
+        file : str
+           path to a label picture
+        image_id : int
+            the id of the image associated to the label
+        categories : dict
+            the dictionary containing for each category,
+            an unique id and a color as (r, g, b) triplet
+        is_crowd : bool
+            specifies whether the segmentation is for a single object (False)
+            or for a group/cluster of objects (True)
+        annotation_id : int
+            the id of the first annotation of the label
+        Returns
+        -------
+            the next available annotation id and the label's annotations
+    """
+    # find the category id from its color
+    categories_ids = {
+        tuple(infos["color"]): infos["id"] for infos in categories.values()
+    }
+    colors = list(categories_ids)
+
+    # read label image
+    with Image.open(file) as mask:
+        mask = mask.convert("RGB")
+    # create sub-masks
+    sub = _create_sub_masks(mask, colors)
+    # create annotations
+    annotations = []
+    for color, sub_mask in sub.items():
+        category_id = categories_ids[color]
+        # create a mask annotation
+        last_annotation_id, annotations_new = _create_sub_mask_annotation(
+            sub_mask, image_id, category_id, annotation_id, is_crowd
+        )
+        # save the created annotation and its id
+        annotation_id = last_annotation_id + 1
+        annotations += annotations_new
+
+    return annotation_id, annotations
+
+
+def _write_annotations(dir_label, images_ids, categories, is_crowd, workers=1):
     """
         Parameters
         ----------
@@ -127,6 +180,9 @@ def _write_annotations(dir_label, images_ids, categories, is_crowd):
         is_crowd : bool
             specifies whether the segmentation is for a single object (False)
             or for a group/cluster of objects (True)
+        workers : int
+            number of processes used to annotate the label pictures.
+            Default value is 1.
         Returns
         -------
             the annotations' dictionary for all labels
@@ -134,38 +190,38 @@ def _write_annotations(dir_label, images_ids, categories, is_crowd):
     # create an empty annotations' dictionary
     annotations_dict = {"annotations": []}
 
-    dir_path = Path(dir_label)
     annotation_id = 1
-    colors = [tuple(group["color"]) for group in categories.values()]
 
-    for file in dir_path.rglob("*.png"):
-        print(file)
-        # read label image
-        mask = Image.open(file)
-        mask = mask.convert("RGB")
-        # create sub-masks
-        sub = _create_sub_masks(mask, colors)
-        # get image id
-        filename = str(file.relative_to(dir_path))
-        image_id = images_ids[filename]
-        # create annotations
-        annotations = []
-        for color, sub_mask in sub.items():
-            # find category id
-            for infos in categories.values():
-                if tuple(infos["color"]) == color:
-                    category_id = infos["id"]
-                    break
-            # create a mask annotation
-            last_annotation_id, annotations_new = _create_sub_mask_annotation(
-                sub_mask, image_id, category_id, annotation_id, is_crowd
-            )
-            # save the created annotation and its id
-            annotation_id = last_annotation_id + 1
-            annotations += annotations_new
-
-        # add these file's annotations in the final dictionary
-        annotations_dict["annotations"] += annotations
+    # get the label files and their image id
+    filenames = list(utils.list_files(dir_label, ".png"))
+    files = [os.path.join(dir_label, filename) for filename in filenames]
+    files_ids = [images_ids[filename] for filename in filenames]
+
+    # labels are annotated independently with ids starting from 0,
+    # then shifted to follow the annotations of the previous labels
+    with ExitStack() as stack:
+        if workers == 1:
+            # a single worker annotates the labels in this process
+            map_labels = map
+        else:
+            executor = stack.enter_context(ProcessPoolExecutor(max_workers=workers))
+            map_labels = executor.map
+        results = map_labels(
+            _annotate_label,
+            files,
+            files_ids,
+            repeat(categories),
+            repeat(is_crowd),
+            repeat(0),
+        )
+        for file, (next_annotation_id, annotations) in zip(files, results):
+            print(file)
+            for annotation in annotations:
+                annotation["id"] += annotation_id
+            annotation_id += next_annotation_id
+
+            # add these file's annotations in the final dictionary
+            annotations_dict["annotations"] += annotations
 
     return annotations_dict
 
@@ -204,14 +260,12 @@ def _write_images(dir_img):
     images_dict = {"images": []}
     images_ids = {}
 
-    dir_path = Path(dir_img)
     img_id = 1
 
-    for file in dir_path.rglob("*.png"):
+    for filename in utils.list_files(dir_img, ".png"):
         # get image info
-        img = Image.open(file)
-        width, height = img.size
-        filename = str(file.relative_to(dir_path))
+        with Image.open(os.path.join(dir_img, filename)) as img:
+            width, height = img.size
         # create image description
         image = {"id": img_id, "width": width, "height": height, "file_name": filename}
         # add this description in the dictionary
@@ -255,6 +309,7 @@ def write_complete_annotations(
     zoom,
     description="Auto-generated by Geolabel-maker",
     output_file="annotations.json",
+    workers=1,
 ):
     """
         Parameters
@@ -277,6 +332,9 @@ def write_complete_annotations(
         output_file : str
             name of the annotation json file which will be created.
             Default name is "annotations.json".
+        workers : int
+            number of processes used to annotate the label tiles.
+            Default value is 1.
         Returns
         -------
             the name of the annotation json file which will be created
@@ -288,7 +346,9 @@ def write_complete_annotations(
     images_dict, images_ids = _write_images(dir_img)
 
     # make annotations part
-    annotations_dict = _write_annotations(dir_label, images_ids, categories, is_crowd)
+    annotations_dict = _write_annotations(
+        dir_label, images_ids, categories, is_crowd, workers=workers
+    )
 
     # make categories part
     categories_dict = _write_categories(list(categories.keys()))
@@ -300,8 +360,9 @@ def write_complete_annotations(
         **categories_dict,
     }
 
-    # write json file
+    # write json file, json.dumps encodes the whole dictionary with
+    # the C encoder so that it is written in a single call
     with open(output_file, "w") as f:
-        json.dump(complete_annotations_dict, f)
+        f.write(json.dumps(complete_annotations_dict))
 
     return output_file
@@ -1,39 +1,135 @@
 #!/usr/bin/env python
 
 "Main module"
+from concurrent.futures import ProcessPoolExecutor, as_completed
 from pathlib import Path
 import begin
-import json
+import multiprocessing
+import os
 
-from geolabel_maker import rasters
-from geolabel_maker import labels
-from geolabel_maker import tiles
-from geolabel_maker import annotations
+from geolabel_maker import utils
+
+# The modules relying on the geospatial libraries are imported by the
+# functions using them, so that the help and argument errors are fast
+
+
+def _check_workers(workers):
+    """
+    Check the number of worker processes given to a command.
+    :param workers: Number of processes
+    """
+    if workers < 1:
+        raise ValueError(f"The number of workers must be at least 1, not {workers}.")
+
+
+def _list_rasters(dir_img):
+    """
+    List the image and label files of a directory.
+    :param dir_img: Image directory path
+    :return the lists of image files and of label files
+    """
+    images = []
+    labels = []
+    with os.scandir(dir_img) as entries:
+        for entry in entries:
+            stem = os.path.splitext(entry.name)[0]
+            if "label" in stem:
+                labels.append(entry.path)
+            else:
+                images.append(entry.path)
+
+    return images, labels
+
+
+def _make_labels(rasters, categories_dict, workers):
+    """
+    Make the label image of each raster.
+    :param rasters: Raster files to label
+    :param categories_dict: Categories read from the JSON file
+    :param workers: Number of processes used to label the images in parallel
+    """
+    from geolabel_maker import labels
+
+    # Read the vector files once for all rasters, before starting
+    # the worker processes. Only forked workers share the parent's memory,
+    # others (spawn, forkserver) would read the vector files again
+    if multiprocessing.get_start_method() == "fork":
+        labels.read_vectors(categories_dict, rasters)
+
+    # Create the label image associated to each raster, rasters being
+    # independent they are processed in parallel
+    try:
+        with ProcessPoolExecutor(max_workers=workers) as executor:
+            futures = [
+                executor.submit(labels.make_label, raster, categories_dict)
+                for raster in rasters
+            ]
+            for future in as_completed(futures):
+                print(f"Created label : {future.result()}")
+    except ValueError:
+        print("Please check your configuration file.")
+
+
+def _make_vrt(dir_img, files, name):
+    """
+    Merge raster files into a virtual raster file.
+    :param dir_img: Image directory path, where the virtual raster is created
+    :param files: Raster files to merge
+    :param name: Name of the merged rasters, "images" or "labels"
+    :return the name of the virtual raster file
+    """
+    from geolabel_maker import rasters
+
+    if len(files) > 0:
+        output_vrt = str(Path(dir_img) / f"{name}.vrt")
+        rasters.make_vrt(files, output_file=output_vrt)
+        print(f"{len(files)} {name} are merged in the file {output_vrt}.")
+    else:
+        raise ValueError(f"Your directory {dir_img} does not contain {name}.")
+
+    return output_vrt
+
+
+def _make_tiles(raster_file, dir_tiles, name, workers, resume=False):
+    """
+    Split a raster into tiles at different zoom levels
+    :param raster_file: Raster file
+    :param dir_tiles: Path to the directory where tiles will be registered
+    :param name: Name of the split raster, "image" or "label"
+    :param workers: Number of processes used to render the tiles
+    :param resume: Only render the tiles missing from a previous run
+    """
+    from geolabel_maker import tiles
+
+    # Get and create the sub-folder
+    dir_imgtiles, dir_labeltiles = tiles.get_tiles_directories(dir_tiles)
+    dir_name_tiles = dir_imgtiles if name == "image" else dir_labeltiles
+    dir_name_tiles.mkdir(parents=True, exist_ok=True)
+
+    tiles.create_tiles(raster_file, dir_name_tiles, nb_processes=workers, resume=resume)
+    print(f"The {name} tiles are created in the folder {dir_name_tiles}.")
 
 
 @begin.subcommand
-def make_labels(dir_img, categories):
+@begin.convert(workers=int)
+def make_labels(dir_img, categories, workers=os.cpu_count() or 1):
     """
     Make the label image from a configuration JSON file.
     :param dir_img: path to the folder containing the images to be labeled
     :param categories: Categories JSON file
+    :param workers: Number of processes used to label the images in parallel
+    (by default it is equal to the number of CPUs)
     """
+    _check_workers(workers)
     print("MAKE LABELS")
     # Read json file
-    with open(categories) as json_file:
-        categories_dict = json.load(json_file)
+    categories_dict = utils.read_json(categories)
 
     # List images
-    img_path = Path(dir_img)
-    rasters = [f for f in img_path.iterdir()]
+    with os.scandir(dir_img) as entries:
+        rasters = [entry.path for entry in entries]
 
-    # Create the label image associated to the merged raster
-    try:
-        for raster in rasters:
-            output_label = labels.make_label(str(raster), categories_dict)
-            print(f"Created label : {output_label}")
-    except ValueError:
-        print("Please check your configuration file.")
+    _make_labels(rasters, categories_dict, workers)
 
 
 @begin.subcommand
@@ -45,69 +141,45 @@ def make_rasters(dir_img):
     """
     print("MAKE VIRTUAL RASTERS")
     # List images and labels files
-    images = []
-    labels = []
-    img_path = Path(dir_img)
-    for f in img_path.iterdir():
-        if "label" in f.stem:
-            labels.append(str(f))
-        else:
-            images.append(str(f))
-
-    # Merge raster images
-    if len(images) > 0:
-        images_vrt = str(img_path / "images.vrt")
-        rasters.make_vrt(images, output_file=images_vrt)
-        print(f"{len(images)} images are merged in the file {images_vrt}.")
-    else:
-        raise ValueError(f"Your directory {dir_img} does not contain images.")
+    images, labels = _list_rasters(dir_img)
 
-    # Merge labels
-    if len(labels) > 0:
-        labels_vrt = str(img_path / "labels.vrt")
-        rasters.make_vrt(labels, output_file=labels_vrt)
-        print(f"{len(labels)} labels are merged in the file {labels_vrt}.")
-    else:
-        raise ValueError(f"Your directory {dir_img} does not contain labels.")
+    # Merge raster images and labels
+    images_vrt = _make_vrt(dir_img, images, "images")
+    labels_vrt = _make_vrt(dir_img, labels, "labels")
 
     return images_vrt, labels_vrt
 
 
 @begin.subcommand
-def make_tiles(raster_file, label_file, dir_tiles):
+@begin.convert(workers=int)
+def make_tiles(
+    raster_file, label_file, dir_tiles, workers=os.cpu_count() or 1, resume=False
+):
     """
     Split raster and label images into tiles at different zoom levels
     :param raster_file: Raster image file
     :param label_file: Label image file
     :param dir_tiles: Path to the directory where tiles will be registered
+    :param workers: Number of processes used to render the tiles
+    (by default it is equal to the number of CPUs)
+    :param resume: Only render the tiles missing from a previous run
     """
+    _check_workers(workers)
     print("MAKE TILES")
-    # Get sub-folder names
-    dir_imgtiles, dir_labeltiles = tiles.get_tiles_directories(dir_tiles)
-
-    # Create sub-folders
-    dir_imgtiles.mkdir(parents=True, exist_ok=True)
-    dir_labeltiles.mkdir(parents=True, exist_ok=True)
-
     # Create image and label tiles
-    tiles.create_tiles(raster_file, dir_imgtiles)
-    print(f"The image tiles are created in the folder {dir_imgtiles}.")
-    tiles.create_tiles(label_file, dir_labeltiles)
-    print(f"The label tiles are created in the folder {dir_labeltiles}.")
+    _make_tiles(raster_file, dir_tiles, "image", workers, resume)
+    _make_tiles(label_file, dir_tiles, "label", workers, resume)
 
 
-@begin.subcommand
-def make_annotations(dir_tiles, config, zoom="18"):
+def _make_annotations(dir_tiles, categories_dict, zoom, workers):
     """
     Create an annotation JSON file in the COCO format for a specific zoom level
     :param dir_tiles: Tiles directory path
-    :param config: Configuration JSON file
-    :param zoom: Zoom level (by default it is equal to 18)
+    :param categories_dict: Categories read from the JSON file
+    :param zoom: Zoom level
+    :param workers: Number of processes used to annotate the label tiles
     """
-    print("MAKE ANNOTATIONS")
-    # Read groups file
-    with open(config) as json_file:
-        config = json.load(json_file)
+    from geolabel_maker import annotations, tiles
 
     # Get sub-folder names
     dir_imgtiles, dir_labeltiles = tiles.get_tiles_directories(dir_tiles)
@@ -118,19 +190,45 @@ def make_annotations(dir_tiles, config, zoom="18"):
     # Create the annotation JSON file
     is_crowd = False
     annotations_json = annotations.write_complete_annotations(
-        dir_imgtiles_zoom, dir_labeltiles_zoom, config, is_crowd, zoom
+        dir_imgtiles_zoom,
+        dir_labeltiles_zoom,
+        categories_dict,
+        is_crowd,
+        zoom,
+        workers=workers,
     )
 
     print(f"The file {annotations_json} contains your annotations.")
 
 
 @begin.subcommand
-def make_all(img, tiles, categories, zoom="18"):
+@begin.convert(workers=int)
+def make_annotations(dir_tiles, config, zoom="18", workers=os.cpu_count() or 1):
+    """
+    Create an annotation JSON file in the COCO format for a specific zoom level
+    :param dir_tiles: Tiles directory path
+    :param config: Configuration JSON file
+    :param zoom: Zoom level (by default it is equal to 18)
+    :param workers: Number of processes used to annotate the label tiles
+    (by default it is equal to the number of CPUs)
+    """
+    _check_workers(workers)
+    print("MAKE ANNOTATIONS")
+    # Read groups file
+    config = utils.read_json(config)
+
+    _make_annotations(dir_tiles, config, zoom, workers)
+
+
+@begin.subcommand
+@begin.convert(workers=int)
+def make_all(img, tiles, categories, zoom="18", workers=os.cpu_count() or 1):
     """
     Run the full process to get a ground truth in the COCO format :
-    1. Make label images
-    2. Create virtual raster files to combine images and labels
-    3. Split image and label virtual files creating tiles
+    1. Make label images, meanwhile the images are combined
+    in a virtual raster file which is split into tiles
+    2. Create a virtual raster file to combine labels
+    3. Split the label virtual file creating tiles
     4. Create an annotation JSON file in the COCO format
     for a specific zoom level
     ----------
@@ -140,19 +238,60 @@ def make_all(img, tiles, categories, zoom="18"):
     :param tiles: Tiles directory path
     :param categories: JSON file path
     :param zoom: Zoom level (by default it is equal to 18)
+    :param workers: Number of processes shared by the steps running
+    at the same time (by default it is equal to the number of CPUs)
     """
+    _check_workers(workers)
 
-    # Create the label image associated to the merged raster
-    make_labels(img, categories)
+    # Read the categories once for all steps
+    categories_dict = utils.read_json(categories)
 
-    # Merge raster files
-    images_vrt, labels_vrt = make_rasters(img)
+    # List the images before any label is created
+    images, _ = _list_rasters(img)
 
-    # Split image and label into tiles
-    make_tiles(images_vrt, labels_vrt, tiles)
+    # Images don't depend on the labels, they are merged and split into
+    # tiles in another process while the labels are created, the workers
+    # are shared between the two branches. With a single worker, the image
+    # tiles are created first, in this process
+    image_workers = workers // 2
+    label_workers = workers - image_workers
+
+    print("MAKE IMAGE TILES")
+    images_vrt = _make_vrt(img, images, "images")
+    if image_workers > 0:
+        images_tiling = multiprocessing.Process(
+            target=_make_tiles, args=(images_vrt, tiles, "image", image_workers)
+        )
+        images_tiling.start()
+    else:
+        images_tiling = None
+        _make_tiles(images_vrt, tiles, "image", label_workers)
+
+    try:
+        # Create the label image associated to each image
+        print("MAKE LABELS")
+        _make_labels(images, categories_dict, label_workers)
+
+        # Merge the labels and split them into tiles
+        print("MAKE LABEL TILES")
+        _, label_files = _list_rasters(img)
+        labels_vrt = _make_vrt(img, label_files, "labels")
+        _make_tiles(labels_vrt, tiles, "label", label_workers)
+    except BaseException:
+        # Don't wait for the image tiles to report the error
+        if images_tiling is not None:
+            images_tiling.terminate()
+        raise
+    finally:
+        if images_tiling is not None:
+            images_tiling.join()
+
+    if images_tiling is not None and images_tiling.exitcode != 0:
+        raise RuntimeError("The image tiles could not be created.")
 
     # Create the annotation file
-    make_annotations(tiles, categories, zoom)
+    print("MAKE ANNOTATIONS")
+    _make_annotations(tiles, categories_dict, zoom, workers)
 
 
 @begin.start(short_args=True, lexical_order=False)
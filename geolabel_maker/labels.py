@@ -1,21 +1,78 @@
 """Create label data from vector files"""
 
 # Import
+# geopandas and matplotlib are slow to import, they are
+# imported by the functions using them
+from functools import lru_cache
 import numpy as np
-import geopandas as gpd
 import rasterio
-import rasterio.mask
+import rasterio.features
+from rasterio.windows import Window
 from shapely.geometry import box
-from PIL import Image, ImageChops
-import matplotlib.pyplot as plt
+from shapely.ops import unary_union
+from shapely.prepared import prep
 from pathlib import Path
 
-from geolabel_maker import utils
+# size of the blocks of the label rasters, in pixels
+LABEL_BLOCK_SIZE = 512
 
-Image.MAX_IMAGE_PIXELS = 156250000
+
+@lru_cache(maxsize=32)
+def _read_vector(vector_file, crs):
+    """
+    Read a vector file and reproject its geometries.
+    The result is cached because the same vector files
+    are used to label every raster.
+
+    Parameters
+    ----------
+    vector_file : str
+        vector file to read
+    crs : str
+        WKT of the coordinate reference system to reproject to
+
+    Returns
+    -------
+    the reprojected geodataframe
+    """
+    import geopandas as gpd
+
+    vector_data = gpd.read_file(vector_file)
+    vector_data = vector_data.to_crs(crs)
+
+    # build the spatial index now so it is cached with the geometries
+    vector_data.sindex
+
+    return vector_data
 
 
-def _select_vector(vector_file, raster_file, save=False, output_file="subset.geojson"):
+def read_vectors(categories, raster_files):
+    """
+    Read and reproject once the vector files of all categories
+    for the rasters to label.
+    Processes forked afterwards share the cached geometries.
+
+    Parameters
+    ----------
+    categories : dict
+        the dictionary containing for each category,
+        the vector file of its geometries
+    raster_files : list of str
+        raster files to label
+    """
+    crs_list = set()
+    for raster_file in raster_files:
+        with rasterio.open(raster_file) as raster_data:
+            crs_list.add(raster_data.crs.to_wkt())
+
+    for crs in crs_list:
+        for infos in categories.values():
+            _read_vector(infos["file"], crs)
+
+
+def _select_vector(
+    vector_file, coordinate, crs, save=False, output_file="subset.geojson"
+):
     """
     Get the geometries which are in the image's extent
 
@@ -23,8 +80,10 @@ def _select_vector(vector_file, raster_file, save=False, output_file="subset.geo
     ----------
     vector_file : str
         vector file to extract
-    raster_file : str
-         raster file for reference
+    coordinate : BoundingBox
+         bounds of the raster for reference
+    crs : str
+         coordinate reference system of the raster, as WKT
     save : bool
          saved the selection in a file or not
     output_file : str
@@ -35,23 +94,23 @@ def _select_vector(vector_file, raster_file, save=False, output_file="subset.geo
     -------
     the geometries of the tif file's geographic extent
     """
-    # read raster file
-    raster_data = rasterio.open(raster_file)
-    coordinate = raster_data.bounds
     # create a polygon from the raster bounds
     raster_bbox = box(*coordinate)
 
     # read vector file
-    vector_data = gpd.read_file(vector_file)
-    vector_data = vector_data.to_crs(raster_data.crs)
+    vector_data = _read_vector(vector_file, crs)
     # create a polygon from the raster bounds
     vector_bbox = box(*vector_data.total_bounds)
 
     if vector_bbox.contains(raster_bbox):
         # select vector data within the raster bounds
+        # using the spatial index instead of scanning all geometries
         Xmin, Xmax = coordinate.left, coordinate.right
         Ymin, Ymax = coordinate.bottom, coordinate.top
-        subset = vector_data.cx[Xmin:Xmax, Ymin:Ymax]
+        index = vector_data.sindex.intersection((Xmin, Ymin, Xmax, Ymax))
+        candidates = vector_data.iloc[sorted(index)]
+        # keep only the geometries which really intersect the raster
+        subset = candidates[candidates.intersects(raster_bbox)]
 
         if save:
             # save the subset geodataframe in a file
@@ -84,54 +143,72 @@ def _create_label(raster_file, categories, dir_label=""):
     -------
     name of the created label image
     """
+    # create file path
+    raster_path = Path(raster_file)
+    output_file = "{}-label.tif".format(raster_path.stem)
+    if dir_label:
+        output_path = Path(dir_label) / output_file
+    else:
+        output_path = raster_path.parent / output_file
+
+    # read the metadata of the raster, the label has the same transform
     with rasterio.open(raster_file) as src:
-        # get metadata
         out_meta = src.meta
 
-        img_list = []
-        for name, infos in categories.items():
-            out_image, out_transform = rasterio.mask.mask(
-                src, infos["geometry"], crop=False
-            )
-
-            out_image = np.rollaxis(out_image, 0, 3)
-
-            # convert image in black & color
-            bw_image = utils.rgb2color(out_image, tuple(infos["color"]))
-
-            # create a PIL image
-            img = Image.fromarray(bw_image.astype(rasterio.uint8))
-
-            img_list.append(img)
-
-    # merge images
-    complete_img = img_list[0]
-    if len(img_list) > 1:
-        for img in img_list[1:]:
-            complete_img = ImageChops.add(complete_img, img)
-
-    # update metadata
+    # pair each category's geometries with the index of its color
+    # in the palette, the index 0 being the black background
+    # the geometries are prepared to be quickly tested against each block
+    palette = [(0, 0, 0)]
+    shapes = []
+    for name, infos in categories.items():
+        geometry = unary_union(infos["geometry"])
+        if not geometry.is_empty:
+            shapes.append((prep(geometry), geometry, len(palette)))
+        palette.append(infos["color"])
+    palette = np.array(palette, dtype=np.uint8)
+
+    # update metadata, the label is tiled to be written block by block
+    # and compressed, its large areas of a single color being very small
+    # once compressed
     out_meta.update(
         {
             "driver": "GTiff",
-            "height": complete_img.size[1],  # bw_image.shape[1],
-            "width": complete_img.size[0],  # bw_image.shape[2],
             "count": 3,
-            "transform": out_transform,
+            "tiled": True,
+            "blockxsize": LABEL_BLOCK_SIZE,
+            "blockysize": LABEL_BLOCK_SIZE,
+            "compress": "DEFLATE",
+            "predictor": 2,
         }
     )
 
-    # create file path
-    raster_path = Path(raster_file)
-    output_file = "{}-label.tif".format(raster_path.stem)
-    if dir_label:
-        output_path = Path(dir_label) / output_file
-    else:
-        output_path = raster_path.parent / output_file
-
-    # create a new raster containing labels
+    # create a new raster containing labels, only one block
+    # of the label is in memory at a time
     with rasterio.open(output_path, "w", **out_meta) as dest:
-        dest.write(np.rollaxis(np.array(complete_img), -1, 0))
+        for _, window in dest.block_windows(1):
+            # keep only the categories intersecting the block,
+            # blocks without any geometry are left to the background
+            block = box(*dest.window_bounds(window))
+            block_shapes = [
+                (geometry, value)
+                for prepared, geometry, value in shapes
+                if prepared.intersects(block)
+            ]
+
+            # burn all the categories in a single pass, the raster's
+            # pixels don't need to be read
+            label_index = np.zeros((window.height, window.width), dtype=np.uint16)
+            if block_shapes:
+                rasterio.features.rasterize(
+                    block_shapes,
+                    out=label_index,
+                    transform=dest.window_transform(window),
+                )
+
+            # create the label block, each category is drawn with its color,
+            # the lookup directly gives the (bands, rows, cols) layout written
+            # by rasterio without any transposed copy
+            dest.write(palette.T[:, label_index], window=window)
 
     return output_path
 
@@ -157,8 +234,13 @@ def make_label(raster_file, categories, dir_label=""):
     -------
     name of the created label image
     """
+    # read the raster's extent once for all categories
+    with rasterio.open(raster_file) as raster_data:
+        coordinate = raster_data.bounds
+        crs = raster_data.crs.to_wkt()
+
     for name, infos in categories.items():
-        infos["geometry"] = _select_vector(infos["file"], raster_file)
+        infos["geometry"] = _select_vector(infos["file"], coordinate, crs)
 
     output_path = _create_label(raster_file, categories, dir_label)
 
@@ -188,12 +270,24 @@ def show(raster_file, label_file, img_size=512, title="", show=True, save=False)
         if True, the figure is saved in a plots folder
         in the same directory as raster file. Default value is False.
     """
+    import matplotlib.pyplot as plt
+
     # get raster file path
     raster_path = Path(raster_file)
 
-    # read images
-    im = Image.open(raster_file)
-    lab = Image.open(label_file)
+    # read images, with the bands as last axis for matplotlib
+    with rasterio.open(raster_file) as src:
+        # select randomly a part of the rasters,
+        # only this part is read from the files
+        window = None
+        if img_size < min(src.width, src.height):
+            randidx = np.random.randint(0, 1 + src.width - img_size)
+            randidy = np.random.randint(0, 1 + src.height - img_size)
+            window = Window(randidx, randidy, img_size, img_size)
+
+        im = np.moveaxis(src.read(window=window), 0, -1).squeeze()
+    with rasterio.open(label_file) as src:
+        lab = np.moveaxis(src.read(window=window), 0, -1).squeeze()
 
     # create figure
     figure, axis = plt.subplots(1, 3, figsize=(12, 6))
@@ -202,18 +296,6 @@ def show(raster_file, label_file, img_size=512, title="", show=True, save=False)
     axis[2].imshow(im)
     axis[2].imshow(lab, alpha=0.5)
 
-    # select randomly a part of the rasters
-    if img_size < np.min(im.size):
-        randidx = np.random.randint(0, 1 + im.size[0] - img_size)
-        randidy = np.random.randint(0, 1 + im.size[1] - img_size)
-
-        axis[0].set_xlim([randidx, randidx + img_size])
-        axis[1].set_xlim([randidx, randidx + img_size])
-        axis[2].set_xlim([randidx, randidx + img_size])
-        axis[0].set_ylim([randidy, randidy + img_size])
-        axis[1].set_ylim([randidy, randidy + img_size])
-        axis[2].set_ylim([randidy, randidy + img_size])
-
     # add title
     image_name = raster_path.stem
     figure.suptitle("{} Image, label from {}".format(title, image_name))
@@ -1,8 +1,19 @@
 from osgeo import gdal
-import rasterio
-import rasterio.merge
+import os
 from shutil import copyfile
 
+from geolabel_maker import utils
+
+# size of the blocks of the merged rasters, in pixels
+BLOCK_SIZE = 512
+# decimation factors of the overviews of the merged rasters,
+# when GDAL has no COG driver to build them
+OVERVIEW_FACTORS = [2, 4, 8, 16, 32]
+# compressions of the merged rasters using a predictor
+LOSSLESS_COMPRESSIONS = ("DEFLATE", "LZW", "ZSTD")
+
+utils.set_gdal_config()
+
 
 def make_vrt(images, output_file="out.vrt"):
     """
@@ -18,10 +29,20 @@ def make_vrt(images, output_file="out.vrt"):
         -------
             the GDAL VRT object
     """
-    return gdal.BuildVRT(output_file, images)
+    vrt = gdal.BuildVRT(output_file, images)
+    if vrt is None:
+        raise RuntimeError(
+            "The virtual raster {} could not be built: {}".format(
+                output_file, gdal.GetLastErrorMsg()
+            )
+        )
+
+    return vrt
 
 
-def merge_rasters(rasters, output_file="merged.tif"):
+def merge_rasters(
+    rasters, output_file="merged.tif", workers=os.cpu_count() or 1, compress="DEFLATE"
+):
     """
         Merge raster files from a specific directory to a single geotiff.
 
@@ -31,6 +52,12 @@ def merge_rasters(rasters, output_file="merged.tif"):
             the images directory path
         output_file : str
             the name of the final raster. Default value is 'merged.tif'.
+        workers : int
+            the number of threads used by GDAL. Default value is the number of CPUs.
+        compress : str
+            the compression of the final raster. JPEG gives much smaller files
+            for 8 bits RGB images but is lossy, so it must not be used for labels.
+            Default value is 'DEFLATE'.
 
         Returns
         -------
@@ -41,29 +68,86 @@ def merge_rasters(rasters, output_file="merged.tif"):
         output_path = img_path / output_file
 
         if len(rasters) > 1:
-            # open raster files
-            src_files_to_mosaic = []
-            for raster in rasters:
-                src = rasterio.open(raster)
-                src_files_to_mosaic.append(src)
-
-            # merge raster images
-            mosaic, output_transform = rasterio.merge.merge(src_files_to_mosaic)
-
-            # create metadata for the merged raster
-            output_metadata = src.meta.copy()
-            output_metadata.update(
-                {
-                    "driver": "GTiff",
-                    "height": mosaic.shape[1],
-                    "width": mosaic.shape[2],
-                    "transform": output_transform,
-                }
-            )
+            # never overwrite one of the rasters to merge
+            if output_path.exists() and any(
+                output_path.samefile(raster) for raster in rasters
+            ):
+                raise ValueError(
+                    "The merged raster {} is one of the rasters to merge.".format(
+                        output_path
+                    )
+                )
+
+            # describe the mosaic with an in-memory virtual raster
+            vrt_file = "/vsimem/{}.vrt".format(output_path.stem)
+            vrt = gdal.BuildVRT(vrt_file, [str(raster) for raster in rasters])
+            if vrt is None:
+                raise RuntimeError(
+                    "The rasters could not be merged: {}".format(gdal.GetLastErrorMsg())
+                )
+
+            # let GDAL stream the mosaic to a cloud optimized geotiff, the COG
+            # driver (GDAL >= 3.1) writes the tiles and their overviews in
+            # a single pass, older GDAL write a tiled geotiff whose overviews
+            # are built afterwards
+            has_cog = gdal.GetDriverByName("COG") is not None
+            is_lossless = compress.upper() in LOSSLESS_COMPRESSIONS
+            if has_cog:
+                driver = "COG"
+                creation_options = [
+                    "BLOCKSIZE={}".format(BLOCK_SIZE),
+                    "OVERVIEW_RESAMPLING=AVERAGE",
+                ]
+                if is_lossless:
+                    creation_options.append("PREDICTOR=YES")
+            else:
+                driver = "GTiff"
+                creation_options = [
+                    "TILED=YES",
+                    "BLOCKXSIZE={}".format(BLOCK_SIZE),
+                    "BLOCKYSIZE={}".format(BLOCK_SIZE),
+                ]
+                if is_lossless:
+                    creation_options.append("PREDICTOR=2")
+            creation_options += [
+                "COMPRESS={}".format(compress),
+                "NUM_THREADS={}".format(workers),
+                "BIGTIFF=IF_SAFER",
+            ]
+
+            # decompress the rasters with the same number of threads, only
+            # during the merge and unless the user already configured it
+            num_threads = gdal.GetConfigOption("GDAL_NUM_THREADS")
+            if num_threads is None:
+                gdal.SetConfigOption("GDAL_NUM_THREADS", str(workers))
+            try:
+                merged = gdal.Translate(
+                    str(output_path),
+                    vrt,
+                    format=driver,
+                    creationOptions=creation_options,
+                )
+                vrt = None
+                gdal.Unlink(vrt_file)
+                if merged is None:
+                    raise RuntimeError(
+                        "The merged raster {} could not be written: {}".format(
+                            output_path, gdal.GetLastErrorMsg()
+                        )
+                    )
 
-            # write the merged raster
-            with rasterio.open(output_path, "w", **output_metadata) as dest:
-                dest.write(mosaic)
+                if not has_cog:
+                    # add overviews, so that readers of the zoomed out levels
+                    # do not have to read the full resolution raster
+                    factors = [
+                        factor
+                        for factor in OVERVIEW_FACTORS
+                        if factor < min(merged.RasterYSize, merged.RasterXSize)
+                    ]
+                    merged.BuildOverviews("AVERAGE", factors)
+                merged = None
+            finally:
+                gdal.SetConfigOption("GDAL_NUM_THREADS", num_threads)
 
         elif len(rasters) == 1:
             copyfile(rasters[0], output_path)
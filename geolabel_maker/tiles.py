@@ -1,4 +1,5 @@
 import gdal2tiles
+import os
 from pathlib import Path, PurePath
 
 from geolabel_maker import utils
@@ -7,8 +8,12 @@ IMG_TILES_DIR = "images"
 LABEL_TILES_DIR = "labels"
 WEBVIEWER = "openlayers"
 
+utils.set_gdal_config()
 
-def create_tiles(raster_file, dir_tiles):
+
+def create_tiles(
+    raster_file, dir_tiles, nb_processes=os.cpu_count() or 1, resume=False
+):
     """
     Create tiles from a raster file (using GDAL)
 
@@ -18,15 +23,22 @@ def create_tiles(raster_file, dir_tiles):
         the filename of a raster
     dir_tiles : Path
         the path to the directory where tiles will be saved
+    nb_processes : int
+        number of processes used to render the tiles.
+        Default value is the number of CPUs.
+    resume : bool
+        only render the missing tiles, keeping those of a previous run.
+        Default value is False.
     """
-    # Check if the tiles directory is empty, else clean it
+    # Check if the tiles directory is empty, else clean it,
+    # unless the tiles of a previous run are resumed
     if not isinstance(dir_tiles, PurePath):
         dir_tiles = Path(dir_tiles)
     is_empty = not any(dir_tiles.iterdir())
-    if not is_empty:
+    if not is_empty and not resume:
         utils.rm_tree(dir_tiles)
 
-    options = {"webviewer": WEBVIEWER}
+    options = {"webviewer": WEBVIEWER, "nb_processes": nb_processes, "resume": resume}
 
     gdal2tiles.generate_tiles(raster_file, dir_tiles, **options)
 
@@ -1,5 +1,14 @@
+import json
 import numpy as np
+import os
 from pathlib import Path
+import shutil
+
+# GDAL configuration of the raster merges and tiling
+GDAL_CONFIG = {
+    "GDAL_CACHEMAX": "512",
+    "VSI_CACHE": "TRUE",
+}
 
 
 def rgb2gray(rgb_img):
@@ -41,6 +50,33 @@ def gray2bw(gray_img):
     return gray_img
 
 
+def pack_rgb(rgb_img):
+    """
+    Pack the (r, g, b) values of each pixel in a single 32 bits integer,
+    so that colors are compared with one integer comparison per pixel
+
+    Parameters
+    ----------
+    rgb_img : numpy array of uint8 with shape as (..., 3)
+        image, or list of colors, to pack
+
+    Returns
+    -------
+    the packed values, with shape as (...)
+    """
+    rgb_img = np.asarray(rgb_img)
+    if rgb_img.dtype != np.uint8:
+        raise ValueError(
+            "Only uint8 images can be packed, not {}.".format(rgb_img.dtype)
+        )
+
+    # add a fourth null byte to each pixel and read the 4 bytes as an integer
+    rgba_img = np.zeros(rgb_img.shape[:-1] + (4,), dtype=np.uint8)
+    rgba_img[..., :3] = rgb_img
+
+    return rgba_img.view(np.uint32)[..., 0]
+
+
 def rgb2color(rgb_img, color):
     """
     Convert an rgb image to a black and color image
@@ -75,10 +111,61 @@ def rm_tree(pth: Path):
     pth : Path
         directory path
     """
-    for child in pth.iterdir():
-        if child.is_file():
-            child.unlink()
-        else:
-            rm_tree(child)
+    # shutil walks the tree with os.scandir, without creating a Path
+    # and calling stat for each entry
+    shutil.rmtree(pth)
+
+
+def list_files(directory, extension):
+    """
+    List recursively the files of a directory having an extension.
+    The directory is walked with os.walk, without creating a Path for each file.
+
+    Parameters
+    ----------
+    directory : str
+        directory path
+    extension : str
+        extension of the listed files, as ".png"
+
+    Returns
+    -------
+    the paths of the files, relative to the directory
+    """
+    for root, _, files in os.walk(directory):
+        relative_root = os.path.relpath(root, directory)
+        for name in files:
+            if name.endswith(extension):
+                yield os.path.normpath(os.path.join(relative_root, name))
+
+
+def read_json(json_file):
+    """
+    Read a JSON file
+
+    Parameters
+    ----------
+    json_file : str
+        path of the JSON file
+
+    Returns
+    -------
+    the decoded JSON content
+    """
+    # reading the raw bytes at once is faster than decoding
+    # the file through a text stream
+    with open(json_file, "rb") as f:
+        return json.loads(f.read())
+
+
+def set_gdal_config():
+    """
+    Set the GDAL configuration options used by the raster merges and tiling:
+    a larger block cache and a cache of the file reads.
+    The options already set, for instance as environment variables, are kept.
+    """
+    from osgeo import gdal
 
-    pth.rmdir()
+    for key, value in GDAL_CONFIG.items():
+        if gdal.GetConfigOption(key) is None:
+            gdal.SetConfigOption(key, value)